@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+import importlib.util
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import matplotlib
 
+# Numba 為選用加速套件：未安裝時退回純 NumPy 執行，計算結果相同
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
 # 強制使用 Agg 後端以確保在 GitHub Actions 等無界面環境穩定執行
 matplotlib.use('Agg')
 
@@ -19,6 +31,32 @@ BIN_SIZE = 10.0
 X_MIN, X_MAX = -100, 100
 BINS = np.arange(X_MIN, X_MAX + 1, BIN_SIZE)
 
+# 統計週期 (名稱, 交易日數) 與計算所需的價格欄位
+PERIODS = [('Week', 5), ('Month', 20), ('Year', 250)]
+PERIOD_DAYS = np.array([days for _, days in PERIODS], dtype=np.int64)
+PRICE_COLS = ['close', 'high', 'low']
+
+# CSV 讀取：有安裝 pyarrow 時使用多執行緒的 Arrow 解析器
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+CSV_ENGINE = 'pyarrow' if HAS_PYARROW else 'c'
+# K 線檔案格式 (依優先順序)：下載器有 pyarrow 時存 Parquet，否則為 CSV
+DAYK_EXTS = ('.parquet', '.csv') if HAS_PYARROW else ('.csv',)
+# 少於 MIN_ROWS 筆 K 線的檔案不具分析意義；每筆至少約 24 bytes，
+# 檔案小於 MIN_FILE_BYTES 時僅憑 stat() 即可略過，不必開檔解析
+MIN_ROWS = 20
+MIN_FILE_BYTES = MIN_ROWS * 24
+
+# 文字報表中的個股連結樣式
+LINK_TEMPLATE = '<a href="{url}" style="text-decoration:none; color:#0366d6;">{code}({name})</a>'
+EXTREME_LINK_TEMPLATE = '<a href="{url}" style="text-decoration:none; color:red; font-weight:bold;">{code}({name}:{pct:.0f}%)</a>'
+
+# 分析結果快取 (需 pyarrow)：以來源檔名 + 修改時間判斷是否需要重算
+CACHE_DIR = Path("./cache")
+CACHE_KEY_COLS = ['File', 'mtime']
+
+# 平行分析時每批派送給子行程的檔案數，用以攤提行程間通訊成本
+ANALYZE_CHUNKSIZE = 32
+
 def get_market_url(market_id, ticker):
     """
     智慧連結引擎：根據市場別生成對應的技術線圖連結
@@ -56,46 +94,156 @@ def get_market_url(market_id, ticker):
         clean_ticker = ticker.split('.')[0]
         return f"https://www.wantgoo.com/stock/{clean_ticker}/technical-chart"
 
-def build_company_list(arr_pct, codes, names, bins, market_id):
+def bin_index(values, edges):
+    """
+    等寬分箱編號 (取代 np.histogram 的 searchsorted 路徑)，超出範圍者歸入首/末箱；
+    並比照 np.histogram 修正浮點誤差造成的邊界錯置，末箱含右邊界
+    """
+    n_bins = len(edges) - 1
+    idx = np.clip(((values - edges[0]) / BIN_SIZE).astype(np.intp), 0, n_bins - 1)
+    idx -= (values < edges[idx])
+    idx += (values >= edges[idx + 1]) & (idx < n_bins - 1)
+    return idx
+
+def build_company_list(arr_pct, codes, names, bins, market_id, urls=None):
     """
     產出 HTML 格式的分箱清單，支援動態超連結與飆股高亮
+    urls 可傳入預先算好的個股連結 (與 codes 對齊)，供多個週期共用
     """
     lines = [f"{'報酬區間':<12} | {'家數(比例)':<14} | 公司清單", "-"*80]
     total = len(arr_pct)
     
-    def make_link(i):
-        url = get_market_url(market_id, codes[i])
-        return f'<a href="{url}" style="text-decoration:none; color:#0366d6;">{codes[i]}({names[i]})</a>'
+    if urls is None:
+        urls = [get_market_url(market_id, c) for c in codes]
+    # 一般區間的連結字串與報酬率無關，進入分箱前一次產生
+    links_all = [LINK_TEMPLATE.format(url=u, code=c, name=n) for u, c, n in zip(urls, codes, names)]
 
-    for lo in range(int(X_MIN), int(X_MAX), int(BIN_SIZE)):
-        up = lo + 10
-        lab = f"{lo}%~{up}%"
-        mask = (arr_pct >= lo) & (arr_pct < up)
-        cnt = int(mask.sum())
+    # 分箱編號：-1 = 低於 X_MIN 或無資料 (不列出)，n_bins = 超過 X_MAX 的極端飆股
+    n_bins = len(bins) - 1
+    bin_idx = np.full(total, -1, dtype=np.intp)
+    in_range = (arr_pct >= X_MIN) & (arr_pct < X_MAX)
+    bin_idx[in_range] = bin_index(arr_pct[in_range], bins)
+    bin_idx[arr_pct >= X_MAX] = n_bins
+
+    # 穩定排序一次後，每個分箱即為 order 中的一段連續切片 (保留原始順序)
+    order = np.argsort(bin_idx, kind='stable')
+    starts = np.searchsorted(bin_idx[order], np.arange(-1, n_bins + 2))
+
+    for b in range(n_bins):
+        picked_indices = order[starts[b + 1]:starts[b + 2]]
+        cnt = len(picked_indices)
         if cnt == 0: continue
         
-        picked_indices = np.where(mask)[0]
-        links = [make_link(idx) for idx in picked_indices]
-        lines.append(f"{lab:<12} | {cnt:>4} ({(cnt/total*100):5.1f}%) | {', '.join(links)}")
+        lo = int(bins[b])
+        up = lo + 10
+        lab = f"{lo}%~{up}%"
+        links = ", ".join(map(links_all.__getitem__, picked_indices.tolist()))
+        lines.append(f"{lab:<12} | {cnt:>4} ({(cnt/total*100):5.1f}%) | {links}")
 
     # 處理 > 100% 的極端飆股
-    extreme_mask = (arr_pct >= 100)
-    e_cnt = int(extreme_mask.sum())
+    e_picked = order[starts[n_bins + 1]:starts[n_bins + 2]]
+    e_cnt = len(e_picked)
     if e_cnt > 0:
-        e_picked = np.where(extreme_mask)[0]
         sorted_e = sorted(e_picked, key=lambda idx: arr_pct[idx], reverse=True)
-        e_links = []
-        for idx in sorted_e:
-            url = get_market_url(market_id, codes[idx])
-            e_links.append(f'<a href="{url}" style="text-decoration:none; color:red; font-weight:bold;">{codes[idx]}({names[idx]}:{arr_pct[idx]:.0f}%)</a>')
+        e_links = [EXTREME_LINK_TEMPLATE.format(url=urls[idx], code=codes[idx], name=names[idx], pct=arr_pct[idx])
+                   for idx in sorted_e]
         
         lines.append(f"{' > 100%':<12} | {e_cnt:>4} ({(e_cnt/total*100):5.1f}%) | {', '.join(e_links)}")
 
     return "\n".join(lines)
 
+@njit(cache=True)
+def compute_returns(close, high, low):
+    """
+    報酬率計算核心：依 PERIODS 順序回傳長度 9 的陣列
+    [週高, 週收, 週低, 月高, 月收, 月低, 年高, 年收, 年低] (%)，
+    資料長度不足或基準價 <= 0 的週期以 NaN 表示；區間內個別缺值 (NaN) 的 K 棒不影響高低點
+    """
+    out = np.full(PERIOD_DAYS.shape[0] * 3, np.nan)
+    n = close.shape[0]
+    for i in range(PERIOD_DAYS.shape[0]):
+        d = PERIOD_DAYS[i]
+        if n <= d: continue
+        prev_c = close[n - d - 1]
+        if prev_c <= 0: continue
+        out[3 * i] = (np.nanmax(high[n - d:]) - prev_c) / prev_c * 100
+        out[3 * i + 1] = (close[n - 1] - prev_c) / prev_c * 100
+        out[3 * i + 2] = (np.nanmin(low[n - d:]) - prev_c) / prev_c * 100
+    return out
+
+def read_prices(f):
+    """
+    僅讀取 close/high/low 三欄，回傳連續記憶體的 float64 陣列 (支援 Parquet 與 CSV)
+    """
+    if f.suffix == '.parquet':
+        df = pd.read_parquet(f, columns=PRICE_COLS)
+        return tuple(np.ascontiguousarray(df[c].to_numpy(dtype=np.float64)) for c in PRICE_COLS)
+    try:
+        df = pd.read_csv(f, engine=CSV_ENGINE, usecols=PRICE_COLS, dtype=np.float64)
+    except (KeyError, ValueError):
+        # 舊版檔案欄位可能為大寫 (Close/High/Low)，改以不分大小寫比對
+        df = pd.read_csv(f, usecols=lambda c: c.lower() in PRICE_COLS)
+        df.columns = [c.lower() for c in df.columns]
+    return tuple(np.ascontiguousarray(df[c].to_numpy(dtype=np.float64)) for c in PRICE_COLS)
+
+def analyze_one(f, market_id):
+    """
+    單檔分析：讀取 K 線檔並計算各週期報酬率，資料不足或讀取失敗時回傳 None
+    (需定義於模組層級，才能交由 ProcessPoolExecutor 序列化派送)
+    """
+    try:
+        if f.stat().st_size < MIN_FILE_BYTES: return None
+        close, high, low = read_prices(f)
+        if len(close) < MIN_ROWS: return None
+        
+        # 解析代號與名稱
+        stem = f.stem
+        
+        # 多國檔名解析策略
+        if market_id in ["hk-share", "jp-share", "kr-share"]:
+            # 港日韓多為單一代號格式 (如 7203.T.csv 或 005930.KS.parquet)
+            tkr = stem
+            nm = stem
+        elif "_" in stem:
+            # 台、美、中 (如 AAPL_Apple.csv 或 600519_貴州茅台.csv)
+            tkr, nm = stem.split('_', 1)
+        else:
+            tkr, nm = stem, stem
+            
+        row = {'Ticker': tkr, 'Full_Name': nm}
+        
+        rets = compute_returns(close, high, low)
+        for i, (p_name, days) in enumerate(PERIODS):
+            if len(close) <= days or np.isnan(rets[3*i+1]): continue
+            row[f'{p_name}_High'] = rets[3*i]
+            row[f'{p_name}_Close'] = rets[3*i+1]
+            row[f'{p_name}_Low'] = rets[3*i+2]
+        return row
+    except Exception:
+        return None
+
+def load_returns_cache(cache_path):
+    """讀取上次的分析結果快取，不存在或無法讀取時回傳空表"""
+    if not HAS_PYARROW or not cache_path.exists():
+        return pd.DataFrame(columns=CACHE_KEY_COLS)
+    try:
+        return pd.read_parquet(cache_path)
+    except Exception as e:
+        print(f"⚠️ 分析快取讀取失敗，將全部重算: {e}")
+        return pd.DataFrame(columns=CACHE_KEY_COLS)
+
+def save_returns_cache(df_all, cache_path):
+    """將本次完整分析結果 (含檔名與修改時間) 寫回快取"""
+    if not HAS_PYARROW: return
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        df_all.to_parquet(cache_path, compression='zstd', index=False)
+    except Exception as e:
+        print(f"⚠️ 分析快取寫入失敗: {e}")
+
 def run_global_analysis(market_id="tw-share"):
     """
-    分析主邏輯：讀取 CSV -> 計算回報率 -> 繪製分布圖 -> 生成文字報表
+    分析主邏輯：讀取 K 線 (Parquet/CSV) -> 計算回報率 -> 繪製分布圖 -> 生成文字報表
     """
     market_label = market_id.upper()
     print(f"📊 正在啟動 {market_label} 深度矩陣分析...")
@@ -104,96 +252,101 @@ def run_global_analysis(market_id="tw-share"):
     image_out_dir = Path("./output/images") / market_id
     image_out_dir.mkdir(parents=True, exist_ok=True)
     
-    all_files = list(data_path.glob("*.csv"))
+    # 同一標的若同時存在 Parquet 與 CSV (EXPORT_CSV 或轉檔過渡期)，以 Parquet 為準
+    dayk_files = {}
+    for ext in DAYK_EXTS:
+        for f in data_path.glob(f"*{ext}"):
+            dayk_files.setdefault(f.stem, f)
+    all_files = list(dayk_files.values())
     if not all_files:
-        print(f"⚠️ 找不到 {market_id} 的 CSV 數據檔案。")
+        print(f"⚠️ 找不到 {market_id} 的 K 線數據檔案。")
         return [], pd.DataFrame(), {}
 
+    # 只重算修改時間與快取不符 (或尚未快取) 的檔案
+    cache_path = CACHE_DIR / f"{market_id}_returns.parquet"
+    mtimes = {f.name: f.stat().st_mtime for f in all_files}
+    cached = load_returns_cache(cache_path)
+    cached = cached[cached['File'].map(mtimes) == cached['mtime']]
+    cached_names = set(cached['File'])
+    todo = [f for f in all_files if f.name not in cached_names]
+    print(f"📦 沿用快取 {len(cached)} 檔，需重新分析 {len(todo)} 檔")
+
     results = []
-    for f in tqdm(all_files, desc=f"分析 {market_label} 數據"):
-        try:
-            df = pd.read_csv(f)
-            if len(df) < 20: continue
-            df.columns = [c.lower() for c in df.columns]
-            close, high, low = df['close'].values, df['high'].values, df['low'].values
-            
-            # 解析代號與名稱
-            stem = f.name.replace(".csv", "")
-            
-            # 多國檔名解析策略
-            if market_id in ["hk-share", "jp-share", "kr-share"]:
-                # 港日韓多為單一代號格式 (如 7203.T.csv 或 005930.KS.csv)
-                tkr = stem
-                nm = stem
-            elif "_" in stem:
-                # 台、美、中 (如 AAPL_Apple.csv 或 600519_貴州茅台.csv)
-                tkr, nm = stem.split('_', 1)
-            else:
-                tkr, nm = stem, stem
-                
-            row = {'Ticker': tkr, 'Full_Name': nm}
-            
-            periods = [('Week', 5), ('Month', 20), ('Year', 250)]
-            for p_name, days in periods:
-                if len(close) <= days: continue
-                prev_c = close[-(days+1)]
-                if prev_c <= 0: continue
-                row[f'{p_name}_High'] = (max(high[-days:]) - prev_c) / prev_c * 100
-                row[f'{p_name}_Close'] = (close[-1] - prev_c) / prev_c * 100
-                row[f'{p_name}_Low'] = (min(low[-days:]) - prev_c) / prev_c * 100
-            results.append(row)
-        except: continue
-
-    df_res = pd.DataFrame(results)
-    if df_res.empty: return [], df_res, {}
+    if todo:
+        # 先於主行程完成 JIT 編譯並寫入快取，子行程直接載入已編譯版本
+        if HAS_NUMBA:
+            warm = np.ones(PERIOD_DAYS.max() + 1)
+            compute_returns(warm, warm, warm)
+
+        # 每檔檔案的讀取與計算彼此獨立，分散至多核心平行處理
+        worker = partial(analyze_one, market_id=market_id)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            rows = executor.map(worker, todo, chunksize=ANALYZE_CHUNKSIZE)
+            for f, r in zip(todo, tqdm(rows, total=len(todo), desc=f"分析 {market_label} 數據")):
+                if r is None: continue
+                r['File'], r['mtime'] = f.name, mtimes[f.name]
+                results.append(r)
+
+    frames = [df for df in (cached, pd.DataFrame(results)) if not df.empty]
+    if not frames: return [], pd.DataFrame(), {}
+    df_all = pd.concat(frames, ignore_index=True)
+    # 依原始檔案順序排列，確保報表輸出與快取命中與否無關
+    file_order = {f.name: i for i, f in enumerate(all_files)}
+    df_all = df_all.sort_values('File', key=lambda s: s.map(file_order), ignore_index=True)
+    save_returns_cache(df_all, cache_path)
+
+    df_res = df_all.drop(columns=CACHE_KEY_COLS).dropna(axis=1, how='all')
 
     # --- 繪圖邏輯 ---
     images = []
     color_map = {'High': '#28a745', 'Close': '#007bff', 'Low': '#dc3545'}
     EXTREME_COLOR = '#FF4500' 
     plot_bins = np.append(BINS, X_MAX + BIN_SIZE)
+    x_labels = [f"{int(x)}%" for x in BINS] + [f">{int(X_MAX)}%"]
 
+    # 九張圖共用同一組 Figure/Axes，每輪僅清空內容重繪，省去重建圖表與字型的成本
+    fig, ax = plt.subplots(figsize=(12, 7))
     for p_n, p_z in [('Week', '週'), ('Month', '月'), ('Year', '年')]:
         for t_n, t_z in [('High', '最高-進攻'), ('Close', '收盤-實質'), ('Low', '最低-防禦')]:
             col = f"{p_n}_{t_n}"
             if col not in df_res.columns: continue
             data = df_res[col].dropna()
             
-            fig, ax = plt.subplots(figsize=(12, 7))
+            ax.clear()
             clipped_data = np.clip(data.values, X_MIN, X_MAX + BIN_SIZE)
-            counts, edges = np.histogram(clipped_data, bins=plot_bins)
+            counts = np.bincount(bin_index(clipped_data, plot_bins), minlength=len(plot_bins) - 1)
+            edges = plot_bins
             
-            ax.bar(edges[:-2], counts[:-1], width=9, align='edge', 
-                   color=color_map[t_n], alpha=0.7, edgecolor='white')
-            ax.bar(edges[-2], counts[-1], width=9, align='edge', 
-                   color=EXTREME_COLOR, alpha=0.9, edgecolor='black', linewidth=1.5)
+            bars = ax.bar(edges[:-2], counts[:-1], width=9, align='edge', 
+                          color=color_map[t_n], alpha=0.7, edgecolor='white')
+            e_bar = ax.bar(edges[-2], counts[-1], width=9, align='edge', 
+                           color=EXTREME_COLOR, alpha=0.9, edgecolor='black', linewidth=1.5)
             
             max_h = counts.max() if len(counts) > 0 else 1
-            for i, h in enumerate(counts):
-                if h > 0:
-                    x_pos = edges[i] + 4.5
-                    is_extreme = (i == len(counts) - 1)
-                    ax.text(x_pos, h + (max_h * 0.02), f'{int(h)}\n({h/len(data)*100:.1f}%)', 
-                            ha='center', va='bottom', fontsize=9, fontweight='bold', 
-                            color='red' if is_extreme else 'black')
+            labels = [f'{int(h)}\n({h/len(data)*100:.1f}%)' if h > 0 else '' for h in counts]
+            ax.bar_label(bars, labels=labels[:-1], padding=3, fontsize=9, fontweight='bold', color='black')
+            ax.bar_label(e_bar, labels=labels[-1:], padding=3, fontsize=9, fontweight='bold', color='red')
 
             ax.set_ylim(0, max_h * 1.4) 
             ax.set_title(f"【{market_label}】{p_z}K {t_z} 報酬分布 (樣本:{len(data)})", fontsize=18, fontweight='bold')
             ax.set_xticks(plot_bins)
-            x_labels = [f"{int(x)}%" for x in BINS] + [f">{int(X_MAX)}%"]
             ax.set_xticklabels(x_labels, rotation=45)
             ax.grid(axis='y', linestyle='--', alpha=0.3)
-            plt.tight_layout()
+            fig.tight_layout()
             
             img_path = image_out_dir / f"{col.lower()}.png"
-            plt.savefig(img_path, dpi=120)
-            plt.close()
+            # 直方圖無細部線條，100 dpi 已足夠郵件顯示 (寬 750px)，並省略 Software 中繼資料
+            fig.savefig(img_path, dpi=100, metadata={'Software': None})
             images.append({'id': col.lower(), 'path': str(img_path), 'label': f"【{market_label}】{p_z}K {t_z}"})
+    plt.close(fig)
 
     text_reports = {}
+    # 代號、名稱與連結在三個週期間相同，只需產生一次
+    codes, names = df_res['Ticker'].tolist(), df_res['Full_Name'].tolist()
+    urls = [get_market_url(market_id, c) for c in codes]
     for p_n in ['Week', 'Month', 'Year']:
         col = f'{p_n}_High'
         if col in df_res.columns:
-            text_reports[p_n] = build_company_list(df_res[col].values, df_res['Ticker'].tolist(), df_res['Full_Name'].tolist(), BINS, market_id)
+            text_reports[p_n] = build_company_list(df_res[col].values, codes, names, BINS, market_id, urls=urls)
     
     return images, df_res, text_reports
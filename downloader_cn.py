@@ -3,6 +3,7 @@ import os, time, random, json, subprocess
 import pandas as pd
 import yfinance as yf
 from datetime import datetime
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
@@ -16,11 +17,19 @@ CACHE_LIST_PATH = os.path.join(BASE_DIR, "cn_stock_list_cache.json")
 
 # 中國 A 股標的極多，建議控制執行緒在 3-4 之間，避免被封 IP
 THREADS_CN = 4
+IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
 os.makedirs(DATA_DIR, exist_ok=True)
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
+def scan_dayk_dir() -> dict:
+    """一次掃描資料夾，回傳 {檔名: stat}，取代每檔各自 exists/getmtime/getsize"""
+    with os.scandir(DATA_DIR) as it:
+        return {e.name: e.stat() for e in it if e.is_file()}
+
 def get_cn_list():
     """使用 akshare 獲取 A 股清單，具備今日快取機制與雙接口備援"""
     if os.path.exists(CACHE_LIST_PATH):
@@ -41,7 +50,7 @@ def get_cn_list():
         valid_prefixes = ('00','30','60','68')
         df = df[df['代码'].str.startswith(valid_prefixes)]
         
-        res = [f"{row['代码']}&{row['名称']}" for _, row in df.iterrows()]
+        res = [f"{code}&{name}" for code, name in zip(df['代码'], df['名称'])]
         
         if len(res) > 1000:
             with open(CACHE_LIST_PATH, "w", encoding="utf-8") as f:
@@ -56,13 +65,13 @@ def get_cn_list():
         try:
             # 備援：原本的 info 接口
             df_bak = ak.stock_info_a_code_name()
-            res_bak = [f"{row['code']}&{row['name']}" for _, row in df_bak.iterrows()]
+            res_bak = [f"{code}&{name}" for code, name in zip(df_bak['code'], df_bak['name'])]
             return res_bak
         except:
             return ["600519&貴州茅台", "000001&平安銀行"]
 
-def download_one(item):
-    """下載 A 股數據，判斷交易所後綴 (.SS 或 .SZ)"""
+def download_one(item, existing_files, today):
+    """下載 A 股數據，判斷交易所後綴 (.SS 或 .SZ)；existing_files 為 scan_dayk_dir 的結果"""
     try:
         code, name = item.split('&', 1)
         # Yahoo Finance 格式：6開頭 (含688) 為上海 .SS, 其餘為深圳 .SZ
@@ -71,13 +80,13 @@ def download_one(item):
         else:
             symbol = f"{code}.SZ"
             
-        out_path = os.path.join(DATA_DIR, f"{code}_{name}.csv")
+        file_name = f"{code}_{name}.csv"
+        out_path = os.path.join(DATA_DIR, file_name)
 
         # ✅ 今日快取檢查
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "code": code}
+        st = existing_files.get(file_name)
+        if st and datetime.fromtimestamp(st.st_mtime).date() == today and st.st_size > 1000:
+            return {"status": "exists", "code": code}
 
         time.sleep(random.uniform(0.5, 1.2))
         tk = yf.Ticker(symbol)
@@ -85,7 +94,7 @@ def download_one(item):
         hist = tk.history(period="2y", timeout=20)
         
         if hist is not None and not hist.empty:
-            hist.reset_index(inplace=True)
+            hist = hist.reset_index()
             hist.columns = [c.lower() for c in hist.columns]
             # 統一存檔格式
             hist.to_csv(out_path, index=False, encoding='utf-8-sig')
@@ -104,15 +113,21 @@ def main():
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
     
     with ThreadPoolExecutor(max_workers=THREADS_CN) as executor:
-        futs = {executor.submit(download_one, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="CN 下載進度")
+        worker = partial(download_one, existing_files=scan_dayk_dir(), today=datetime.now().date())
+        futs = {executor.submit(worker, it): it for it in items}
+        pbar = tqdm(total=len(items), desc="CN 下載進度", mininterval=1.0,
+                    miniters=max(50, len(items) // 200), disable=IS_GITHUB_ACTIONS)
+        done = 0
         for f in as_completed(futs):
             res = f.result()
             stats[res.get("status", "error")] += 1
             pbar.update(1)
+            done += 1
+            if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                log(f"⏳ A 股下載進度：{done}/{len(items)} ({done / len(items):.0%})")
             
             # 每處理 100 檔稍微休息，防止 IP 封鎖
-            if pbar.n % 100 == 0:
+            if done % 100 == 0:
                 time.sleep(random.uniform(5, 10))
         pbar.close()
     
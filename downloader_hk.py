@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import os, io, time, random, sqlite3, requests
+import os, io, time, json, random, sqlite3, requests, queue, threading
 import pandas as pd
 import yfinance as yf
 from io import StringIO
@@ -15,11 +15,36 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 MARKET_CODE = "hk-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "hk_stock_warehouse.db")
+# 清單快取放在 data/<market>/lists (GitHub Actions 會快取此目錄)，36 小時內沿用，不重抓港交所 Excel
+# 排程每個交易日執行一次，相隔約 24 小時，TTL 需多留排程延遲的餘裕才會命中
+LIST_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, "lists")
+CACHE_LIST_PATH = os.path.join(LIST_DIR, "hk_stock_list_cache.json")
+LIST_CACHE_TTL = 36 * 3600
+# 表頭只會出現在 Excel 前幾行，不必掃描整張表
+HEADER_SCAN_ROWS = 30
 IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
 
 # ✅ 效能調優
 MAX_WORKERS = 3 if IS_GITHUB_ACTIONS else 5 
 
+# ✅ 寫入設定：下載執行緒只負責抓資料，由單一寫入執行緒批次寫入 SQLite
+WRITE_BATCH_ROWS = 5000
+PRICE_COLS = ['date', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+INSERT_PRICES_SQL = f"INSERT OR REPLACE INTO stock_prices ({', '.join(PRICE_COLS)}) VALUES ({', '.join(['?'] * len(PRICE_COLS))})"
+WRITE_Q = queue.Queue()
+
+# ✅ 空間回收設定 (PRAGMA auto_vacuum: 0=NONE, 1=FULL, 2=INCREMENTAL)
+AUTO_VACUUM_INCREMENTAL = 2
+INCREMENTAL_VACUUM_PAGES = 2000
+# 空閒頁面低於此數量時不做回收 (只新增資料的日常執行幾乎不會產生空閒頁)
+FREELIST_VACUUM_MIN = 1000
+# 每週完整 VACUUM 的日子 (週五；排程 cron 只在週一至週五 UTC 執行，週末不會觸發)
+FULL_VACUUM_WEEKDAY = 4
+
+os.makedirs(LIST_DIR, exist_ok=True)
+
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
@@ -28,6 +53,12 @@ def log(msg: str):
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     try:
+        # 增量空間回收：須在建表前設定才生效，既有的舊資料庫以一次性 VACUUM 轉換
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table'").fetchone():
+                log("🔧 正在將資料庫轉換為增量回收模式 (一次性 VACUUM)...")
+                conn.execute("VACUUM")
         conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
                             date TEXT, symbol TEXT, open REAL, high REAL, 
                             low REAL, close REAL, volume INTEGER,
@@ -49,10 +80,97 @@ def init_db():
     finally:
         conn.close()
 
+def writer_loop(write_q, write_state):
+    """
+    唯一持有資料庫寫入連線的執行緒：累積至 WRITE_BATCH_ROWS 筆後以單一交易寫入，
+    收到 None 時寫出剩餘資料並結束。
+    批次失敗時逐檔重試，仍失敗的代號記入 write_state['failed']；
+    執行緒本身出錯 (例如無法開啟資料庫) 則記入 write_state['error']，由 run_sync 改判結果
+    """
+    conn = None
+    buf = []
+
+    def write_rows(rows):
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(INSERT_PRICES_SQL, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
+    def flush():
+        if not buf: return
+        try:
+            write_rows(buf)
+        except Exception as e:
+            log(f"⚠️ 批次寫入失敗 ({len(buf)} 筆)，改為逐檔重試: {e}")
+            by_symbol = {}
+            for row in buf:
+                by_symbol.setdefault(row[1], []).append(row)
+            for symbol, rows in by_symbol.items():
+                try:
+                    write_rows(rows)
+                except Exception as e:
+                    write_state['failed'].add(symbol)
+                    log(f"❌ {symbol} 寫入失敗: {e}")
+        buf.clear()
+
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            rows = write_q.get()
+            if rows is None: break
+            buf.extend(rows)
+            if len(buf) >= WRITE_BATCH_ROWS: flush()
+        flush()
+    except Exception as e:
+        write_state['error'] = e
+        log(f"❌ 寫入執行緒異常終止: {e}")
+    finally:
+        if conn is not None: conn.close()
+
+def compact_db():
+    """資料庫空間回收：平日只歸還空閒頁面，每週五才完整 VACUUM 重寫整個檔案"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if datetime.now().weekday() == FULL_VACUUM_WEEKDAY:
+            log("🧹 每週資料庫 VACUUM...")
+            conn.execute("VACUUM")
+        else:
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages < FREELIST_VACUUM_MIN:
+                log(f"🧹 空閒頁面僅 {free_pages} 頁，略過回收")
+                return
+            log(f"🧹 資料庫增量回收 (空閒頁面 {free_pages})...")
+            # 需以 executescript 執行至完成，cursor.execute 只會回收第一頁
+            conn.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});")
+    finally:
+        conn.close()
+
 # ========== 3. 獲取港股清單 (強化穩定性) ==========
 
+def load_cached_list(max_age=None):
+    """讀取清單快取；max_age 為 None 時不論新舊都讀 (失敗時的備援)"""
+    if not os.path.exists(CACHE_LIST_PATH):
+        return []
+    if max_age is not None and time.time() - os.path.getmtime(CACHE_LIST_PATH) > max_age:
+        return []
+    try:
+        with open(CACHE_LIST_PATH, "r", encoding="utf-8") as f:
+            return [tuple(item) for item in json.load(f)]
+    except Exception:
+        return []
+
 def get_hk_stock_list():
     """獲取港股清單並確保寫入 stock_info"""
+    cached = load_cached_list(LIST_CACHE_TTL)
+    if cached:
+        log(f"📦 偵測到 {LIST_CACHE_TTL // 3600} 小時內的港股清單快取，直接載入：{len(cached)} 檔")
+        return cached
+
     url = "https://www.hkex.com.hk/-/media/HKEX-Market/Services/Trading/Securities/Securities-Lists/Securities-Using-Standard-Transfer-Form-(including-GEM)-By-Stock-Code-Order/secstkorder.xls"
     
     # 模擬完整瀏覽器 Header
@@ -70,52 +188,62 @@ def get_hk_stock_list():
         # 讀取 Excel
         df_raw = pd.read_excel(io.BytesIO(r.content), header=None)
         
-        # 尋找包含 "Stock Code" 的正確起始行
-        hdr_idx = None
-        for i in range(len(df_raw)):
-            row_str = " ".join([str(x) for x in df_raw.iloc[i].values])
-            if "Stock Code" in row_str:
-                hdr_idx = i
-                break
+        # 尋找包含 "Stock Code" 的正確起始行 (只掃前幾行，整塊向量化比對)
+        head = df_raw.head(HEADER_SCAN_ROWS).astype(str)
+        hits = head.apply(lambda col: col.str.contains("Stock Code", regex=False)).any(axis=1)
+        hdr_idx = hits.idxmax() if hits.any() else None
         
         if hdr_idx is None: 
             log("❌ 找不到 Excel 表頭，請檢查網址是否有變。")
             return []
         
         # 重新整理 DataFrame
-        df = df_raw.iloc[hdr_idx+1:].copy()
+        df = df_raw.iloc[hdr_idx+1:]
         df.columns = df_raw.iloc[hdr_idx].values
         
-        conn = sqlite3.connect(DB_PATH)
+        # 港股名稱可能在不同欄位名下 (English Stock Short Name)，迴圈外只找一次
+        name_col = next((c for c in df.columns if 'Short Name' in str(c) and 'English' in str(c)), None)
+        today = datetime.now().strftime("%Y-%m-%d")
+
         stock_list = []
-        
-        # 💡 先清空舊 info 數據確保重新同步
-        conn.execute("DELETE FROM stock_info")
-
-        for _, row in df.iterrows():
-            raw_code = str(row['Stock Code']).strip()
-            # 港股名稱可能在不同欄位名下 (English Stock Short Name)
-            name_col = [c for c in df.columns if 'Short Name' in str(c) and 'English' in str(c)]
-            name = str(row[name_col[0]]).strip() if name_col else "Unknown"
+        info_rows = []
+
+        # 直接以欄位陣列配對逐列處理，不建立每列的 Series
+        names = df[name_col] if name_col is not None else ["Unknown"] * len(df)
+        for raw, raw_name in zip(df['Stock Code'], names):
+            raw_code = str(raw).strip()
+            name = str(raw_name).strip()
             
             # 港股普通股邏輯：數字且長度 <= 4 (或是 5 位但前幾位是 0)
             if raw_code.isdigit() and int(raw_code) < 10000:
                 symbol = f"{raw_code.zfill(4)}.HK"
                 market = "HKEX"
                 
-                conn.execute("""
-                    INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (symbol, name, "Unknown", market, datetime.now().strftime("%Y-%m-%d")))
+                info_rows.append((symbol, name, "Unknown", market, today))
                 stock_list.append((symbol, name))
-                
-        conn.commit()
+        
+        # 💡 先清空舊 info 數據確保重新同步，再以單一交易批次寫入
+        conn = sqlite3.connect(DB_PATH)
+        with conn:
+            conn.execute("DELETE FROM stock_info")
+            conn.executemany("""
+                INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
+                VALUES (?, ?, ?, ?, ?)
+            """, info_rows)
         conn.close()
+        if stock_list:
+            with open(CACHE_LIST_PATH, "w", encoding="utf-8") as f:
+                json.dump(stock_list, f, ensure_ascii=False)
         log(f"✅ 港股清單同步完成：{len(stock_list)} 檔")
         return stock_list
         
     except Exception as e:
         log(f"⚠️ 港股名單獲取異常: {e}")
+        # 優先退回上一次成功的清單快取 (即使已過期)
+        stale = load_cached_list()
+        if stale:
+            log(f"📦 改用舊的港股清單快取：{len(stale)} 檔")
+            return stale
         # 萬一失敗，返回基本的藍籌股名單確保程序不崩潰
         return [("0700.HK", "TENCENT"), ("09988.HK", "BABA-SW"), ("00005.HK", "HSBC HOLDINGS")]
 
@@ -137,19 +265,17 @@ def download_one(args):
             if hist is None or hist.empty:
                 return {"symbol": symbol, "status": "empty"}
                 
-            hist.reset_index(inplace=True)
-            hist.columns = [c.lower() for c in hist.columns]
-            if 'date' in hist.columns:
-                hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
+            # 處理日期格式：直接由索引轉成當地日期字串，不做 reset_index / 欄名轉換
+            idx = hist.index
+            dates = (idx.tz_localize(None) if idx.tz is not None else idx).strftime('%Y-%m-%d').tolist()
             
-            df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final['symbol'] = symbol
+            # 依 PRICE_COLS 順序組成列 (tolist 轉回 Python 型別，sqlite3 才能綁定)
+            rows = list(zip(dates, [symbol] * len(dates),
+                            hist['Open'].tolist(), hist['High'].tolist(), hist['Low'].tolist(),
+                            hist['Close'].tolist(), hist['Volume'].tolist()))
             
-            conn = sqlite3.connect(DB_PATH, timeout=60)
-            df_final.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                            method=lambda table, conn, keys, data_iter: 
-                            conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            conn.close()
+            # 交給寫入執行緒批次寫入，不在下載執行緒中連線資料庫
+            WRITE_Q.put(rows)
             
             return {"symbol": symbol, "status": "success"}
         except Exception:
@@ -170,19 +296,38 @@ def run_sync(mode='hot'):
 
     stats = {"success": 0, "empty": 0, "error": 0}
     fail_list = []
+    ok_list = []
     
+    write_state = {"failed": set(), "error": None}
+    writer = threading.Thread(target=writer_loop, args=(WRITE_Q, write_state), daemon=True)
+    writer.start()
+
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         futures = {executor.submit(download_one, (it[0], it[1], mode)): it[0] for it in items}
-        for f in tqdm(as_completed(futures), total=len(items), desc="HK同步"):
+        pbar = tqdm(as_completed(futures), total=len(items), desc="HK同步", mininterval=1.0,
+                    miniters=max(50, len(items) // 200), disable=IS_GITHUB_ACTIONS)
+        for done, f in enumerate(pbar, 1):
             res = f.result()
             s = res.get("status", "error")
             stats[s if s in stats else 'error'] += 1
             if s == "error": fail_list.append(res.get("symbol"))
+            elif s == "success": ok_list.append(res.get("symbol"))
+            if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                log(f"⏳ 港股同步進度：{done}/{len(items)} ({done / len(items):.0%})")
 
-    log("🧹 資料庫 VACUUM...")
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("VACUUM")
-    conn.close()
+    # 通知寫入執行緒收尾，待所有資料落盤後再進行後續維護
+    WRITE_Q.put(None)
+    writer.join()
+
+    # 下載成功但未能寫入資料庫的代號改判為失敗；寫入執行緒異常終止時無從確認哪些已落盤，全數改判
+    lost = ok_list if write_state['error'] else [sym for sym in ok_list if sym in write_state['failed']]
+    if lost:
+        log(f"❌ {len(lost)} 檔資料未能寫入資料庫，改列為失敗")
+        stats['success'] -= len(lost)
+        stats['error'] += len(lost)
+        fail_list.extend(lost)
+
+    compact_db()
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
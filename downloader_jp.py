@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import os, sys, time, random, subprocess, sqlite3
+import os, sys, time, random, subprocess, sqlite3, queue, threading
 import pandas as pd
 import yfinance as yf
 from datetime import datetime
@@ -22,10 +22,26 @@ MARKET_CODE = "jp-share"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "jp_stock_warehouse.db")
 IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
 
 # ✅ 效能設定
 MAX_WORKERS = 3 if IS_GITHUB_ACTIONS else 5
 
+# ✅ 寫入設定：下載執行緒只負責抓資料，由單一寫入執行緒批次寫入 SQLite
+WRITE_BATCH_ROWS = 5000
+PRICE_COLS = ['date', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+INSERT_PRICES_SQL = f"INSERT OR REPLACE INTO stock_prices ({', '.join(PRICE_COLS)}) VALUES ({', '.join(['?'] * len(PRICE_COLS))})"
+WRITE_Q = queue.Queue()
+
+# ✅ 空間回收設定 (PRAGMA auto_vacuum: 0=NONE, 1=FULL, 2=INCREMENTAL)
+AUTO_VACUUM_INCREMENTAL = 2
+INCREMENTAL_VACUUM_PAGES = 2000
+# 空閒頁面低於此數量時不做回收 (只新增資料的日常執行幾乎不會產生空閒頁)
+FREELIST_VACUUM_MIN = 1000
+# 每週完整 VACUUM 的日子 (週五；排程 cron 只在週一至週五 UTC 執行，週末不會觸發)
+FULL_VACUUM_WEEKDAY = 4
+
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
@@ -34,6 +50,12 @@ def log(msg: str):
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     try:
+        # 增量空間回收：須在建表前設定才生效，既有的舊資料庫以一次性 VACUUM 轉換
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table'").fetchone():
+                log("🔧 正在將資料庫轉換為增量回收模式 (一次性 VACUUM)...")
+                conn.execute("VACUUM")
         # 價格表
         conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
                             date TEXT, symbol TEXT, open REAL, high REAL, 
@@ -56,6 +78,76 @@ def init_db():
     finally:
         conn.close()
 
+def writer_loop(write_q, write_state):
+    """
+    唯一持有資料庫寫入連線的執行緒：累積至 WRITE_BATCH_ROWS 筆後以單一交易寫入，
+    收到 None 時寫出剩餘資料並結束。
+    批次失敗時逐檔重試，仍失敗的代號記入 write_state['failed']；
+    執行緒本身出錯 (例如無法開啟資料庫) 則記入 write_state['error']，由 run_sync 改判結果
+    """
+    conn = None
+    buf = []
+
+    def write_rows(rows):
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(INSERT_PRICES_SQL, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
+    def flush():
+        if not buf: return
+        try:
+            write_rows(buf)
+        except Exception as e:
+            log(f"⚠️ 批次寫入失敗 ({len(buf)} 筆)，改為逐檔重試: {e}")
+            by_symbol = {}
+            for row in buf:
+                by_symbol.setdefault(row[1], []).append(row)
+            for symbol, rows in by_symbol.items():
+                try:
+                    write_rows(rows)
+                except Exception as e:
+                    write_state['failed'].add(symbol)
+                    log(f"❌ {symbol} 寫入失敗: {e}")
+        buf.clear()
+
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            rows = write_q.get()
+            if rows is None: break
+            buf.extend(rows)
+            if len(buf) >= WRITE_BATCH_ROWS: flush()
+        flush()
+    except Exception as e:
+        write_state['error'] = e
+        log(f"❌ 寫入執行緒異常終止: {e}")
+    finally:
+        if conn is not None: conn.close()
+
+def compact_db():
+    """資料庫空間回收：平日只歸還空閒頁面，每週五才完整 VACUUM 重寫整個檔案"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if datetime.now().weekday() == FULL_VACUUM_WEEKDAY:
+            log("🧹 每週資料庫 VACUUM...")
+            conn.execute("VACUUM")
+        else:
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages < FREELIST_VACUUM_MIN:
+                log(f"🧹 空閒頁面僅 {free_pages} 頁，略過回收")
+                return
+            log(f"🧹 資料庫增量回收 (空閒頁面 {free_pages})...")
+            # 需以 executescript 執行至完成，cursor.execute 只會回收第一頁
+            conn.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});")
+    finally:
+        conn.close()
+
 # ========== 3. 獲取日股清單 (修復 API 問題) ==========
 
 def get_jp_stock_list():
@@ -69,25 +161,31 @@ def get_jp_stock_list():
         code_col = next((c for c in ['コード', 'Code', 'code', 'Local Code'] if c in df.columns), None)
         name_col = next((c for c in ['銘柄名', 'Name', 'name', 'Issues'] if c in df.columns), None)
         sector_col = next((c for c in ['33業種区分', 'Sector', 'industry'] if c in df.columns), None)
+        today = datetime.now().strftime("%Y-%m-%d")
 
-        conn = sqlite3.connect(DB_PATH)
         stock_list = []
+        info_rows = []
         
-        for _, row in df.iterrows():
-            raw_code = str(row[code_col]).strip()
+        # 直接以欄位陣列配對逐列處理，不建立每列的 Series
+        names = df[name_col] if name_col else ["Unknown"] * len(df)
+        sectors = df[sector_col] if sector_col else ["Unknown"] * len(df)
+        for raw, raw_name, raw_sector in zip(df[code_col], names, sectors):
+            raw_code = str(raw).strip()
             if len(raw_code) >= 4 and raw_code[:4].isdigit():
                 symbol = f"{raw_code[:4]}.T"
-                name = str(row[name_col]).strip() if name_col else "Unknown"
-                sector = str(row[sector_col]).strip() if sector_col else "Unknown"
+                name = str(raw_name).strip()
+                sector = str(raw_sector).strip()
                 
-                # 寫入資訊表
-                conn.execute("""
-                    INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (symbol, name, sector, "TSE", datetime.now().strftime("%Y-%m-%d")))
+                info_rows.append((symbol, name, sector, "TSE", today))
                 stock_list.append((symbol, name))
         
-        conn.commit()
+        # 寫入資訊表 (單一交易批次寫入)
+        conn = sqlite3.connect(DB_PATH)
+        with conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
+                VALUES (?, ?, ?, ?, ?)
+            """, info_rows)
         conn.close()
         log(f"✅ 成功獲取 {len(stock_list)} 檔日股資訊")
         return stock_list
@@ -112,22 +210,17 @@ def download_one(args):
             if hist is None or hist.empty:
                 return {"symbol": symbol, "status": "empty"}
                 
-            hist.reset_index(inplace=True)
-            hist.columns = [c.lower() for c in hist.columns]
+            # 處理日期格式：直接由索引轉成當地日期字串，不做 reset_index / 欄名轉換
+            idx = hist.index
+            dates = (idx.tz_localize(None) if idx.tz is not None else idx).strftime('%Y-%m-%d').tolist()
             
-            # 處理日期格式
-            if 'date' in hist.columns:
-                hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
+            # 依 PRICE_COLS 順序組成列 (tolist 轉回 Python 型別，sqlite3 才能綁定)
+            rows = list(zip(dates, [symbol] * len(dates),
+                            hist['Open'].tolist(), hist['High'].tolist(), hist['Low'].tolist(),
+                            hist['Close'].tolist(), hist['Volume'].tolist()))
             
-            df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final['symbol'] = symbol
-            
-            # 寫入資料庫
-            conn = sqlite3.connect(DB_PATH, timeout=60)
-            df_final.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                            method=lambda table, conn, keys, data_iter: 
-                            conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            conn.close()
+            # 交給寫入執行緒批次寫入，不在下載執行緒中連線資料庫
+            WRITE_Q.put(rows)
             
             return {"symbol": symbol, "status": "success"}
         except:
@@ -148,20 +241,39 @@ def run_sync(mode='hot'):
 
     stats = {"success": 0, "empty": 0, "error": 0}
     fail_list = []
+    ok_list = []
     
+    write_state = {"failed": set(), "error": None}
+    writer = threading.Thread(target=writer_loop, args=(WRITE_Q, write_state), daemon=True)
+    writer.start()
+
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         futures = {executor.submit(download_one, (it[0], it[1], mode)): it[0] for it in items}
-        for f in tqdm(as_completed(futures), total=len(items), desc="JP同步"):
+        pbar = tqdm(as_completed(futures), total=len(items), desc="JP同步", mininterval=1.0,
+                    miniters=max(50, len(items) // 200), disable=IS_GITHUB_ACTIONS)
+        for done, f in enumerate(pbar, 1):
             res = f.result()
             s = res.get("status", "error")
             stats[s if s in stats else 'error'] += 1
             if s == "error": fail_list.append(res.get("symbol"))
+            elif s == "success": ok_list.append(res.get("symbol"))
+            if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                log(f"⏳ 日股同步進度：{done}/{len(items)} ({done / len(items):.0%})")
+
+    # 通知寫入執行緒收尾，待所有資料落盤後再進行後續維護
+    WRITE_Q.put(None)
+    writer.join()
+
+    # 下載成功但未能寫入資料庫的代號改判為失敗；寫入執行緒異常終止時無從確認哪些已落盤，全數改判
+    lost = ok_list if write_state['error'] else [sym for sym in ok_list if sym in write_state['failed']]
+    if lost:
+        log(f"❌ {len(lost)} 檔資料未能寫入資料庫，改列為失敗")
+        stats['success'] -= len(lost)
+        stats['error'] += len(lost)
+        fail_list.extend(lost)
 
     # 資料庫優化
-    log("🧹 執行資料庫優化 (VACUUM)...")
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("VACUUM")
-    conn.close()
+    compact_db()
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
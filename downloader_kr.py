@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
-import os, sys, time, random, logging, warnings, subprocess, json
+import os, sys, time, random, logging, warnings, subprocess, json, importlib.util
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 import yfinance as yf
 
@@ -32,6 +33,15 @@ os.makedirs(LIST_DIR, exist_ok=True)
 # 續跑清單紀錄檔案
 MANIFEST_CSV = Path(LIST_DIR) / "kr_manifest.csv"
 THREADS = 4
+IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
+
+# K 線存檔格式：有 pyarrow 時存成 Parquet (zstd 壓縮、免解析)，否則維持 CSV；
+# 設定 EXPORT_CSV=1 可額外輸出 CSV 供舊版工具讀取
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+DAYK_EXT = ".parquet" if HAS_PYARROW else ".csv"
+EXPORT_CSV = os.getenv("EXPORT_CSV", "").lower() in ("1", "true")
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
@@ -42,16 +52,17 @@ def map_symbol_kr(code: str, board: str) -> str:
     return f"{str(code).zfill(6)}{suffix}"
 
 def standardize_df(df: pd.DataFrame) -> pd.DataFrame:
-    """將 yfinance 原始資料標準化"""
+    """將 yfinance 原始資料標準化 (直接以 NumPy 陣列組成，省去逐步的 pandas 轉換)"""
     if df is None or df.empty: return pd.DataFrame()
-    df = df.reset_index()
-    df.columns = [c.lower() for c in df.columns]
-    if 'date' not in df.columns: return pd.DataFrame()
+    if not isinstance(df.index, pd.DatetimeIndex): return pd.DataFrame()
+    cols = {c.lower(): c for c in df.columns}
+    req = ['open','high','low','close','volume']
+    if not all(c in cols for c in req): return pd.DataFrame()
     
-    # 移除時區資訊
-    df['date'] = pd.to_datetime(df['date'], utc=True).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-    req = ['date','open','high','low','close','volume']
-    return df[req] if all(c in df.columns for c in req) else pd.DataFrame()
+    # DatetimeIndex.values 為 UTC 時間，截斷至日即為移除時區後的日期
+    data = {'date': np.datetime_as_string(df.index.values.astype('datetime64[D]'))}
+    data.update({c: df[cols[c]].to_numpy() for c in req})
+    return pd.DataFrame(data)
 
 def get_kr_list():
     """從 KRX 獲取最新 KOSPI/KOSDAQ 普通股清單"""
@@ -62,11 +73,10 @@ def get_kr_list():
         # 抓取 KOSPI (KS) 與 KOSDAQ (KQ)
         for mk, bd in [("KOSPI","KS"), ("KOSDAQ","KQ")]:
             tickers = krx.get_market_ticker_list(today, market=mk)
-            for t in tickers:
+            # 過濾：排除優先股 (通常代號第6位不是0) 與 衍生品，只替保留的標的查名稱
+            for t in (t for t in tickers if t.endswith('0')):
                 name = krx.get_market_ticker_name(t)
-                # 過濾：排除優先股 (通常代號第6位不是0) 與 衍生品
-                if t.endswith('0'): 
-                    lst.append({"code": t, "name": name, "board": bd, "status": "pending"})
+                lst.append({"code": t, "name": name, "board": bd, "status": "pending"})
         
         df = pd.DataFrame(lst)
         log(f"✅ 成功獲取 {len(df)} 檔韓國普通股標的")
@@ -76,13 +86,42 @@ def get_kr_list():
         # 基礎備援
         return pd.DataFrame([{"code":"005930","name":"三星電子","board":"KS", "status": "pending"}])
 
+def save_dayk(df: pd.DataFrame, out_base: str):
+    """依 DAYK_EXT 寫出 K 線檔 (out_base 不含副檔名)"""
+    if HAS_PYARROW:
+        df.to_parquet(out_base + ".parquet", engine="pyarrow", compression="zstd", index=False)
+    if EXPORT_CSV or not HAS_PYARROW:
+        df.to_csv(out_base + ".csv", index=False, encoding='utf-8-sig')
+
+def migrate_csv_to_parquet():
+    """把舊版留下的 CSV 轉存為 Parquet 並刪除 (保留原 mtime，今日快取判斷不受影響)"""
+    if not HAS_PYARROW or EXPORT_CSV:
+        return
+    converted = 0
+    with os.scandir(DATA_DIR) as it:
+        csv_paths = [e.path for e in it if e.is_file() and e.name.endswith(".csv")]
+    for csv_path in csv_paths:
+        pq_path = csv_path[:-len(".csv")] + ".parquet"
+        try:
+            if not os.path.exists(pq_path):
+                st = os.stat(csv_path)
+                pd.read_csv(csv_path).to_parquet(pq_path, engine="pyarrow", compression="zstd", index=False)
+                os.utime(pq_path, (st.st_atime, st.st_mtime))
+                converted += 1
+            os.remove(csv_path)
+        except Exception as e:
+            log(f"⚠️ CSV 轉檔失敗 {os.path.basename(csv_path)}: {e}")
+    if converted:
+        log(f"📦 已將 {converted} 個舊版 CSV 轉存為 Parquet")
+
 def download_one(row_data):
     """下載單一韓股 K 線數據"""
     idx, row = row_data
     code, board = row['code'], row['board']
     symbol = map_symbol_kr(code, board)
-    # 存檔名稱範例: 005930.KS.csv
-    out_path = os.path.join(DATA_DIR, f"{code}.{board}.csv")
+    # 存檔名稱範例: 005930.KS.parquet
+    out_base = os.path.join(DATA_DIR, f"{code}.{board}")
+    out_path = out_base + DAYK_EXT
     
     # ✅ 今日快取檢查
     if os.path.exists(out_path):
@@ -97,7 +136,7 @@ def download_one(row_data):
         df = standardize_df(df_raw)
         
         if not df.empty:
-            df.to_csv(out_path, index=False, encoding='utf-8-sig')
+            save_dayk(df, out_base)
             return idx, "done"
         return idx, "empty"
     except:
@@ -113,13 +152,17 @@ def main():
     if mf.empty:
         return {"total": 0, "success": 0, "fail": 0}
 
-    # 2. 偵測本機已存在的檔案 (續跑機制)
-    existing_files = [f for f in os.listdir(DATA_DIR) if f.endswith(".csv")]
-    for f in existing_files:
-        code_part = f.replace(".csv", "")
-        if "." in code_part:
-            c, b = code_part.split(".")
-            mf.loc[(mf['code'] == c) & (mf['board'] == b), "status"] = "exists"
+    # 2. 偵測本機已存在的檔案 (續跑機制)：先轉換舊版 CSV，再一次建好 (code, board) 集合整欄比對
+    migrate_csv_to_parquet()
+    existing = {
+        tuple(f[:-len(DAYK_EXT)].split(".", 1))
+        for f in os.listdir(DATA_DIR)
+        if f.endswith(DAYK_EXT) and "." in f[:-len(DAYK_EXT)]
+    }
+    mf["status"] = [
+        "exists" if (c, b) in existing else st
+        for c, b, st in zip(mf["code"], mf["board"], mf["status"])
+    ]
 
     todo = mf[mf["status"] == "pending"]
     log(f"📝 總標的：{len(mf)} | 待處理：{len(todo)} | 已存在：{len(mf[mf['status']=='exists'])}")
@@ -130,14 +173,17 @@ def main():
     if not todo.empty:
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
             futures = {executor.submit(download_one, item): item for item in todo.iterrows()}
-            pbar = tqdm(total=len(todo), desc="韓股下載進度")
+            pbar = tqdm(total=len(todo), desc="韓股下載進度", mininterval=1.0,
+                        miniters=max(50, len(todo) // 200), disable=IS_GITHUB_ACTIONS)
             
-            for f in as_completed(futures):
+            for done, f in enumerate(as_completed(futures), 1):
                 idx, status = f.result()
                 mf.at[idx, "status"] = status
                 if status in ["done", "empty", "failed"]:
                     stats[status if status != "done" else "done"] += 1
                 pbar.update(1)
+                if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                    log(f"⏳ 韓股下載進度：{done}/{len(todo)} ({done / len(todo):.0%})")
             pbar.close()
 
     # 4. 儲存續跑清單
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import importlib.util
 import random
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 import yfinance as yf
-from io import StringIO
+import lxml.html
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
@@ -15,14 +21,140 @@ MARKET_CODE = "tw-share"
 DATA_SUBDIR = "dayK"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, DATA_SUBDIR)
+# 清單下載的條件式 GET 快取 (ETag / Last-Modified + 解析結果)
+LIST_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, "lists")
 
 # ✅ 效能優化：調低至 3，配合隨機延遲可有效避開 Yahoo 封鎖
 MAX_WORKERS = 3 
+IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
 Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
+Path(LIST_DIR).mkdir(parents=True, exist_ok=True)
+
+# K 線存檔格式：有 pyarrow 時存成 Parquet (zstd 壓縮、免解析)，否則維持 CSV；
+# 設定 EXPORT_CSV=1 可額外輸出 CSV 供舊版工具讀取
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+DAYK_EXT = ".parquet" if HAS_PYARROW else ".csv"
+EXPORT_CSV = os.getenv("EXPORT_CSV", "").lower() in ("1", "true")
+
+# 輸出的 K 線欄位 (yfinance 原始欄名 -> 小寫欄名)
+OHLCV_COLS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# 清單下載共用連線池 (同一主機只做一次 TLS 交握)，並對暫時性錯誤自動重試；
+# yfinance 自行管理 session，不套用於 K 線下載
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])))
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
+class SafeNameTable(dict):
+    """str.translate 用的字元表：英數字與空白/底線/連字號保留，其餘刪除；首次遇到的字元才判斷並記住"""
+    def __missing__(self, cp):
+        ch = chr(cp)
+        self[cp] = keep = cp if ch.isalnum() or ch in (' ', '_', '-') else None
+        return keep
+
+SAFE_NAME_TABLE = SafeNameTable()
+
+def safe_filename(name: str) -> str:
+    """移除檔名非法字元"""
+    return name.translate(SAFE_NAME_TABLE).strip()
+
+def cached_list_get(url: str, cache_name: str, headers: dict, parse) -> list:
+    """條件式 GET：帶上次的 ETag / Last-Modified 詢問伺服器，304 時直接沿用上次解析好的清單"""
+    cache_path = os.path.join(LIST_DIR, cache_name)
+    cached = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except Exception:
+            cached = {}
+
+    req_headers = dict(headers)
+    if cached.get("etag"): req_headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"): req_headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = SESSION.get(url, headers=req_headers, timeout=15)
+    if resp.status_code == 304 and "items" in cached:
+        return cached["items"]
+    resp.raise_for_status()
+
+    items = parse(resp.text)
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if items and (etag or last_modified):
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"etag": etag, "last_modified": last_modified, "items": items}, f, ensure_ascii=False)
+    return items
+
+def save_dayk(df: pd.DataFrame, out_base: str):
+    """依 DAYK_EXT 寫出 K 線檔 (out_base 不含副檔名)"""
+    if HAS_PYARROW:
+        df.to_parquet(out_base + ".parquet", engine="pyarrow", compression="zstd", index=False)
+    if EXPORT_CSV or not HAS_PYARROW:
+        df.to_csv(out_base + ".csv", index=False, encoding='utf-8-sig')
+
+def migrate_csv_to_parquet():
+    """把舊版留下的 CSV 轉存為 Parquet 並刪除 (保留原 mtime，今日快取判斷不受影響)"""
+    if not HAS_PYARROW or EXPORT_CSV:
+        return
+    converted = 0
+    with os.scandir(DATA_DIR) as it:
+        csv_paths = [e.path for e in it if e.is_file() and e.name.endswith(".csv")]
+    for csv_path in csv_paths:
+        pq_path = csv_path[:-len(".csv")] + ".parquet"
+        try:
+            if not os.path.exists(pq_path):
+                st = os.stat(csv_path)
+                pd.read_csv(csv_path).to_parquet(pq_path, engine="pyarrow", compression="zstd", index=False)
+                os.utime(pq_path, (st.st_atime, st.st_mtime))
+                converted += 1
+            os.remove(csv_path)
+        except Exception as e:
+            log(f"⚠️ CSV 轉檔失敗 {os.path.basename(csv_path)}: {e}")
+    if converted:
+        log(f"📦 已將 {converted} 個舊版 CSV 轉存為 Parquet")
+
+def scan_dayk_dir() -> dict:
+    """一次掃描資料夾，回傳 {檔名: stat}，取代每檔各自 exists/getmtime/getsize"""
+    with os.scandir(DATA_DIR) as it:
+        return {e.name: e.stat() for e in it if e.is_file()}
+
+def to_dayk_frame(hist: pd.DataFrame) -> pd.DataFrame:
+    """由 yfinance 歷史資料直接以 NumPy 陣列組成 date + OHLCV 表 (日期為台北當地日期)"""
+    idx = hist.index
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+    data = {'date': np.datetime_as_string(idx.values.astype('datetime64[D]'))}
+    data.update({c.lower(): hist[c].to_numpy() for c in OHLCV_COLS})
+    return pd.DataFrame(data)
+
+def parse_isin_page(text: str, suffix: str) -> list:
+    """以 lxml XPath 直接解析證交所 ISIN 表格 (不經 pd.read_html / DataFrame)，代號保留前導 0"""
+    # 找出表頭含「有價證券代號」的資料表，只取該表自身的列 (不含巢狀或頁尾表格)
+    for table in lxml.html.fromstring(text).xpath("//table"):
+        rows = table.xpath("./tr|./thead/tr|./tbody/tr")
+        if not rows: continue
+        header = [td.text_content().strip() for td in rows[0].xpath("./td|./th")]
+        if '有價證券代號' in header and '有價證券名稱' in header: break
+    else:
+        return []
+    code_idx, name_idx = header.index('有價證券代號'), header.index('有價證券名稱')
+    
+    items = []
+    for tr in rows[1:]:
+        cells = tr.xpath("./td")
+        if len(cells) <= max(code_idx, name_idx): continue
+        code = cells[code_idx].text_content().strip()
+        name = cells[name_idx].text_content().strip()
+        if code and '有價證券' not in code:
+            items.append(f"{code}{suffix}&{name}")
+    return items
+
 def get_full_stock_list():
     """獲取台股全市場清單 (雙重機制：證交所 JSP + Akshare 備援)"""
     url_configs = [
@@ -36,20 +168,20 @@ def get_full_stock_list():
     all_items = []
     log("📡 [方案 A] 正在從證交所 JSP 獲取清單...")
     
-    for cfg in url_configs:
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
+
+    def fetch_cfg(cfg):
         try:
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-            resp = requests.get(cfg['url'], timeout=15, headers=headers)
-            df_list = pd.read_html(StringIO(resp.text), header=0)
-            if not df_list: continue
-            df = df_list[0]
-            for _, row in df.iterrows():
-                code = str(row['有價證券代號']).strip()
-                name = str(row['有價證券名稱']).strip()
-                if code and '有價證券' not in code:
-                    all_items.append(f"{code}{cfg['suffix']}&{name}")
+            return cached_list_get(
+                cfg['url'], f"twse_{cfg['name']}.json", headers,
+                partial(parse_isin_page, suffix=cfg['suffix']))
         except Exception as e:
-            continue
+            return []
+
+    # 各頁面互不相依，同時發出請求；map 依 url_configs 順序回傳，去重結果不變
+    with ThreadPoolExecutor(max_workers=len(url_configs)) as executor:
+        for items in executor.map(fetch_cfg, url_configs):
+            all_items.extend(items)
 
     # --- 方案 B: Akshare 備援 (當證交所失敗時) ---
     if len(all_items) < 500:
@@ -58,9 +190,7 @@ def get_full_stock_list():
             import akshare as ak
             # 獲取上市與上櫃清單
             df_tw_listed = ak.stock_tw_spot_em() # 台灣市場即時行情
-            for _, row in df_tw_listed.iterrows():
-                code = str(row['代码'])
-                name = str(row['名称'])
+            for code, name in zip(df_tw_listed['代码'].astype(str), df_tw_listed['名称'].astype(str)):
                 # Akshare 的代號通常需要判斷 .TW 或 .TWO
                 # 這裡簡單處理：如果是上市公司通常是 .TW，其餘 .TWO
                 suffix = ".TW" if len(code) == 4 and code.startswith(('2', '1', '3')) else ".TWO"
@@ -68,26 +198,30 @@ def get_full_stock_list():
         except Exception as e:
             log(f"❌ 備援方案亦失敗: {e}")
 
-    final_res = list(set(all_items))
+    # 以代號去重並保留首次出現的順序 (同代號不同名稱也只留一筆)
+    unique = {}
+    for it in all_items:
+        unique.setdefault(it.split('&', 1)[0], it)
+    final_res = list(unique.values())
     log(f"✅ 台股清單獲取完成，共 {len(final_res)} 檔標的。")
     return final_res
 
-def download_stock_data(item):
-    """具備隨機延遲與自動重試的下載邏輯"""
+def download_stock_data(item, existing_files, today):
+    """具備隨機延遲與自動重試的下載邏輯 (existing_files 為 scan_dayk_dir 的結果)"""
     yf_tkr = "ParseError"
     try:
         parts = item.split('&', 1)
         if len(parts) < 2: return {"status": "error", "tkr": item}
         
         yf_tkr, name = parts
-        safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
-        out_path = os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
+        safe_name = safe_filename(name)
+        stem = f"{yf_tkr}_{safe_name}"
+        out_base = os.path.join(DATA_DIR, stem)
         
         # 今日快取檢查
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "tkr": yf_tkr}
+        st = existing_files.get(stem + DAYK_EXT)
+        if st and datetime.fromtimestamp(st.st_mtime).date() == today and st.st_size > 1000:
+            return {"status": "exists", "tkr": yf_tkr}
 
         time.sleep(random.uniform(0.5, 1.2))
         tk = yf.Ticker(yf_tkr)
@@ -96,9 +230,7 @@ def download_stock_data(item):
             try:
                 hist = tk.history(period="2y", timeout=15)
                 if hist is not None and not hist.empty:
-                    hist.reset_index(inplace=True)
-                    hist.columns = [c.lower() for c in hist.columns]
-                    hist.to_csv(out_path, index=False, encoding='utf-8-sig')
+                    save_dayk(to_dayk_frame(hist), out_base)
                     return {"status": "success", "tkr": yf_tkr}
                 if attempt == 1: return {"status": "empty", "tkr": yf_tkr}
             except:
@@ -119,16 +251,23 @@ def main():
     
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
 
+    migrate_csv_to_parquet()
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_stock_data, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="台股下載")
+        worker = partial(download_stock_data, existing_files=scan_dayk_dir(), today=datetime.now().date())
+        futures = {executor.submit(worker, it): it for it in items}
+        pbar = tqdm(total=len(items), desc="台股下載", mininterval=1.0,
+                    miniters=max(50, len(items) // 200), disable=IS_GITHUB_ACTIONS)
         
+        done = 0
         for future in as_completed(futures):
             res = future.result()
             stats[res["status"]] += 1
             pbar.update(1)
+            done += 1
+            if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                log(f"⏳ 台股下載進度：{done}/{len(items)} ({done / len(items):.0%})")
             
-            if pbar.n % 100 == 0:
+            if done % 100 == 0:
                 time.sleep(random.uniform(5, 10))
         pbar.close()
     
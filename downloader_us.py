@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import importlib.util
 import random
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import yfinance as yf
 from datetime import datetime
 from io import StringIO
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
@@ -17,23 +21,119 @@ MARKET_CODE = "us-share"
 DATA_SUBDIR = "dayK"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, DATA_SUBDIR)
+# 清單下載的條件式 GET 快取 (ETag / Last-Modified + 解析結果)
+LIST_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, "lists")
 # 清單快取路徑
 CACHE_LIST_PATH = os.path.join(BASE_DIR, "us_stock_list_cache.json")
 
 # 美股標的多，建議 4-5 執行緒，並配合隨機延遲
 MAX_WORKERS = 4 
+IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
+# 進度條：本機降低重繪頻率；GitHub Actions 上關閉進度條，改為每 N 檔輸出一行日誌
+PROGRESS_LOG_EVERY = 500
 Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
+Path(LIST_DIR).mkdir(parents=True, exist_ok=True)
+
+# K 線存檔格式：有 pyarrow 時存成 Parquet (zstd 壓縮、免解析)，否則維持 CSV；
+# 設定 EXPORT_CSV=1 可額外輸出 CSV 供舊版工具讀取
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+DAYK_EXT = ".parquet" if HAS_PYARROW else ".csv"
+EXPORT_CSV = os.getenv("EXPORT_CSV", "").lower() in ("1", "true")
+
+# 清單下載共用連線池 (同一主機只做一次 TLS 交握)，並對暫時性錯誤自動重試；
+# yfinance 自行管理 session，不套用於 K 線下載
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])))
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
-def classify_security(name: str, is_etf: bool) -> str:
-    """過濾邏輯：排除 ETF 與 衍生品 (Warrant, Rights 等)"""
-    if is_etf: return "Exclude"
-    n_upper = str(name).upper()
-    exclude_keywords = ["WARRANT", "RIGHTS", "UNIT", "PREFERRED", "DEBENTURE"]
-    if any(kw in n_upper for kw in exclude_keywords): return "Exclude"
-    return "Common Stock"
+class SafeNameTable(dict):
+    """str.translate 用的字元表：英數字與空白/底線/連字號保留，其餘刪除；首次遇到的字元才判斷並記住"""
+    def __missing__(self, cp):
+        ch = chr(cp)
+        self[cp] = keep = cp if ch.isalnum() or ch in (' ', '_', '-') else None
+        return keep
+
+SAFE_NAME_TABLE = SafeNameTable()
+
+def safe_filename(name: str) -> str:
+    """移除檔名非法字元"""
+    return name.translate(SAFE_NAME_TABLE).strip()
+
+def cached_list_get(url: str, cache_name: str, headers: dict, parse) -> list:
+    """條件式 GET：帶上次的 ETag / Last-Modified 詢問伺服器，304 時直接沿用上次解析好的清單"""
+    cache_path = os.path.join(LIST_DIR, cache_name)
+    cached = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except Exception:
+            cached = {}
+
+    req_headers = dict(headers)
+    if cached.get("etag"): req_headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"): req_headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = SESSION.get(url, headers=req_headers, timeout=15)
+    if resp.status_code == 304 and "items" in cached:
+        return cached["items"]
+    resp.raise_for_status()
+
+    items = parse(resp.text)
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if items and (etag or last_modified):
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"etag": etag, "last_modified": last_modified, "items": items}, f, ensure_ascii=False)
+    return items
+
+def save_dayk(df: pd.DataFrame, out_base: str):
+    """依 DAYK_EXT 寫出 K 線檔 (out_base 不含副檔名)"""
+    if HAS_PYARROW:
+        df.to_parquet(out_base + ".parquet", engine="pyarrow", compression="zstd", index=False)
+    if EXPORT_CSV or not HAS_PYARROW:
+        df.to_csv(out_base + ".csv", index=False, encoding='utf-8-sig')
+
+def migrate_csv_to_parquet():
+    """把舊版留下的 CSV 轉存為 Parquet 並刪除 (保留原 mtime，今日快取判斷不受影響)"""
+    if not HAS_PYARROW or EXPORT_CSV:
+        return
+    converted = 0
+    with os.scandir(DATA_DIR) as it:
+        csv_paths = [e.path for e in it if e.is_file() and e.name.endswith(".csv")]
+    for csv_path in csv_paths:
+        pq_path = csv_path[:-len(".csv")] + ".parquet"
+        try:
+            if not os.path.exists(pq_path):
+                st = os.stat(csv_path)
+                pd.read_csv(csv_path).to_parquet(pq_path, engine="pyarrow", compression="zstd", index=False)
+                os.utime(pq_path, (st.st_atime, st.st_mtime))
+                converted += 1
+            os.remove(csv_path)
+        except Exception as e:
+            log(f"⚠️ CSV 轉檔失敗 {os.path.basename(csv_path)}: {e}")
+    if converted:
+        log(f"📦 已將 {converted} 個舊版 CSV 轉存為 Parquet")
+
+def scan_dayk_dir() -> dict:
+    """一次掃描資料夾，回傳 {檔名: stat}，取代每檔各自 exists/getmtime/getsize"""
+    with os.scandir(DATA_DIR) as it:
+        return {e.name: e.stat() for e in it if e.is_file()}
+
+# 名稱含以下關鍵字者視為衍生品 (Warrant, Rights 等)
+EXCLUDE_KEYWORDS = ["WARRANT", "RIGHTS", "UNIT", "PREFERRED", "DEBENTURE"]
+EXCLUDE_PATTERN = "|".join(EXCLUDE_KEYWORDS)
+
+def common_stock_rows(df: pd.DataFrame, sym_col: str) -> list:
+    """過濾邏輯：排除測試標的、ETF 與衍生品，整欄向量化判斷後回傳 "代號&名稱" 清單"""
+    df = df[df["Test Issue"] == "N"].dropna(subset=[sym_col, "Security Name"])
+    names = df["Security Name"].astype(str)
+    is_common = (df["ETF"] != "Y") & ~names.str.upper().str.contains(EXCLUDE_PATTERN, regex=True, na=False)
+    symbols = df.loc[is_common, sym_col].astype(str).str.strip().str.replace('$', '-', regex=False)
+    return [f"{sym}&{name}" for sym, name in zip(symbols, names[is_common])]
 
 def get_full_stock_list():
     """
@@ -53,29 +153,23 @@ def get_full_stock_list():
 
     # 1. NASDAQ 市場清單
     try:
-        r1 = requests.get("https://www.nasdaqtrader.com/dynamic/symdir/nasdaqlisted.txt", timeout=15, headers=headers)
-        df1 = pd.read_csv(StringIO(r1.text), sep="|")
-        df1 = df1[df1["Test Issue"] == "N"].dropna(subset=["Symbol", "Security Name"])
-        for _, row in df1.iterrows():
-            name = str(row["Security Name"])
-            if classify_security(name, row["ETF"] == "Y") == "Common Stock":
-                symbol = str(row['Symbol']).strip().replace('$', '-')
-                all_rows.append(f"{symbol}&{name}")
+        all_rows.extend(cached_list_get(
+            "https://www.nasdaqtrader.com/dynamic/symdir/nasdaqlisted.txt", "nasdaqlisted.json", headers,
+            lambda text: common_stock_rows(pd.read_csv(StringIO(text), sep="|"), "Symbol")))
     except Exception as e: log(f"⚠️ NASDAQ 獲取失敗: {e}")
 
     # 2. NYSE 與其餘市場清單
     try:
-        r2 = requests.get("https://www.nasdaqtrader.com/dynamic/symdir/otherlisted.txt", timeout=15, headers=headers)
-        df2 = pd.read_csv(StringIO(r2.text), sep="|")
-        df2 = df2[df2["Test Issue"] == "N"].dropna(subset=["NASDAQ Symbol", "Security Name"])
-        for _, row in df2.iterrows():
-            name = str(row["Security Name"])
-            if classify_security(name, row["ETF"] == "Y") == "Common Stock":
-                symbol = str(row['NASDAQ Symbol']).strip().replace('$', '-')
-                all_rows.append(f"{symbol}&{name}")
+        all_rows.extend(cached_list_get(
+            "https://www.nasdaqtrader.com/dynamic/symdir/otherlisted.txt", "otherlisted.json", headers,
+            lambda text: common_stock_rows(pd.read_csv(StringIO(text), sep="|"), "NASDAQ Symbol")))
     except Exception as e: log(f"⚠️ NYSE/Other 獲取失敗: {e}")
 
-    final_list = list(set(all_rows))
+    # 以代號去重並保留首次出現的順序 (同代號不同名稱也只留一筆)
+    unique = {}
+    for it in all_rows:
+        unique.setdefault(it.split('&', 1)[0], it)
+    final_list = list(unique.values())
     
     if final_list:
         with open(CACHE_LIST_PATH, "w", encoding="utf-8") as f:
@@ -86,9 +180,9 @@ def get_full_stock_list():
         log("❌ 無法獲取任何美股標的清單。")
         return []
 
-def download_stock_data(item):
+def download_stock_data(item, existing_files, today):
     """
-    ⚡ 檔案級快取下載邏輯
+    ⚡ 檔案級快取下載邏輯 (existing_files 為 scan_dayk_dir 的結果)
     """
     try:
         parts = item.split('&', 1)
@@ -96,14 +190,14 @@ def download_stock_data(item):
         yf_tkr, name = parts
         
         # 移除檔名非法字元
-        safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
-        out_path = os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
+        safe_name = safe_filename(name)
+        stem = f"{yf_tkr}_{safe_name}"
+        out_base = os.path.join(DATA_DIR, stem)
         
         # ✅ 快取檢查：檢查檔案是否存在且是今天更新的
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "tkr": yf_tkr}
+        st = existing_files.get(stem + DAYK_EXT)
+        if st and datetime.fromtimestamp(st.st_mtime).date() == today and st.st_size > 1000:
+            return {"status": "exists", "tkr": yf_tkr}
 
         # --- 若無快取則下載 ---
         time.sleep(random.uniform(0.4, 1.2))
@@ -113,9 +207,9 @@ def download_stock_data(item):
             try:
                 hist = tk.history(period="2y", timeout=20)
                 if hist is not None and not hist.empty:
-                    hist.reset_index(inplace=True)
+                    hist = hist.reset_index()
                     hist.columns = [c.lower() for c in hist.columns]
-                    hist.to_csv(out_path, index=False, encoding='utf-8-sig')
+                    save_dayk(hist, out_base)
                     return {"status": "success", "tkr": yf_tkr}
                 if attempt == 1: return {"status": "empty", "tkr": yf_tkr}
             except Exception as e:
@@ -135,17 +229,24 @@ def main():
     log(f"🚀 啟動美股下載任務，目標總數: {len(items)}")
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
     
+    migrate_csv_to_parquet()
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_stock_data, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="美股下載進度", unit="檔")
+        worker = partial(download_stock_data, existing_files=scan_dayk_dir(), today=datetime.now().date())
+        futures = {executor.submit(worker, it): it for it in items}
+        pbar = tqdm(total=len(items), desc="美股下載進度", unit="檔", mininterval=1.0,
+                    miniters=max(50, len(items) // 200), disable=IS_GITHUB_ACTIONS)
         
+        done = 0
         for future in as_completed(futures):
             res = future.result()
             stats[res.get("status", "error")] += 1
             pbar.update(1)
+            done += 1
+            if IS_GITHUB_ACTIONS and done % PROGRESS_LOG_EVERY == 0:
+                log(f"⏳ 美股下載進度：{done}/{len(items)} ({done / len(items):.0%})")
             
             # 每成功下載 100 檔額外休息，防止被 Yahoo 封鎖
-            if pbar.n % 100 == 0:
+            if done % 100 == 0:
                 time.sleep(random.uniform(10, 20))
         pbar.close()
     
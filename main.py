@@ -3,7 +3,7 @@ import os
 import time
 import argparse
 import traceback
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 # 導入自定義模組
 import downloader_tw
@@ -15,6 +15,9 @@ import downloader_kr
 import analyzer
 import notifier
 
+# 台北時間 (UTC+8)
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
 def run_market_pipeline(market_id, market_name, emoji):
     """
     執行單一市場的完整管線：下載 -> 分析 -> 寄信
@@ -88,7 +91,9 @@ def run_market_pipeline(market_id, market_name, emoji):
             stats=stats
         )
         
-        if success_sent:
+        if success_sent is None:
+            print(f"⏭️ {market_name} 報告內容與上次相同，本次未重複寄送。")
+        elif success_sent:
             print(f"✅ {market_name} 監控報告已成功寄達！")
         else:
             print(f"❌ {market_name} 報告寄送失敗 (請檢查 API Key 或日誌)。")
@@ -105,8 +110,7 @@ def main():
     start_time = time.time()
     
     # 獲取台北時間 (UTC+8) 供 Log 記錄
-    now_utc8 = datetime.utcnow() + timedelta(hours=8)
-    now_str = now_utc8.strftime("%Y-%m-%d %H:%M:%S")
+    now_str = datetime.now(TAIPEI_TZ).strftime("%Y-%m-%d %H:%M:%S")
     
     print("\n" + "🚀 " + "="*55)
     print(f"🚀 全球股市監控自動化系統啟動")
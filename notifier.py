@@ -1,9 +1,127 @@
 # -*- coding: utf-8 -*-
 import os
-import requests
-import resend
-import pandas as pd
-from datetime import datetime, timedelta
+import io
+import json
+import base64
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# 台北時間 (UTC+8)
+TAIPEI_TZ = timezone(timedelta(hours=8))
+
+# ========== 重複報告偵測 ==========
+# 內容摘要與上次寄出的相同時 (例如休市日重跑) 略過寄送；FORCE_SEND=1 可強制寄出
+REPORT_STATE_DIR = Path(os.getenv("REPORT_STATE_DIR", "./cache"))
+FORCE_SEND = os.getenv("FORCE_SEND", "").lower() in ("1", "true")
+
+# ========== Telegram 共用連線 ==========
+# 模組層級共用 (keep-alive)：main.py 每個市場各建一個 StockNotifier，連線需跨實例共用才有效益
+TG_SESSION = None
+TG_SESSION_LOCK = threading.Lock()
+# 連線池與重試設定：各市場的背景發送執行緒可能同時送出，共用同一個連線池
+TG_POOL_MAXSIZE = 4
+TG_MAX_RETRIES = 2
+TG_RETRY_STATUS = [429, 502, 503, 504]
+
+def get_tg_session():
+    """取得 Telegram 共用 Session，首次發送時才建立 (未設定 Telegram 時不需要載入 requests)"""
+    global TG_SESSION
+    with TG_SESSION_LOCK:
+        if TG_SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            session = requests.Session()
+            # sendMessage 為 POST，需明確允許重試；429 會依 Retry-After 等待
+            session.mount("https://api.telegram.org", HTTPAdapter(
+                pool_connections=1, pool_maxsize=TG_POOL_MAXSIZE,
+                max_retries=Retry(total=TG_MAX_RETRIES, backoff_factor=0.2, status_forcelist=TG_RETRY_STATUS,
+                                  allowed_methods=frozenset({"POST"}))))
+            TG_SESSION = session
+        return TG_SESSION
+
+def shrink_png(data: bytes) -> bytes:
+    """以 256 色調色盤 + optimize 重新壓縮 PNG 圖表，只有變小時才採用 (未安裝 Pillow 時原樣回傳)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            buf = io.BytesIO()
+            im.convert("RGB").quantize(colors=256).save(buf, format="PNG", optimize=True)
+        out = buf.getvalue()
+        return out if len(out) < len(data) else data
+    except Exception:
+        return data
+
+# ========== HTML 報表模板 (模組載入時建立一次，寄信時僅 format 填值) ==========
+REPORT_HEAD_TEMPLATE = """
+        <html>
+        <body style="font-family: 'Microsoft JhengHei', sans-serif; color: #333; line-height: 1.6;">
+            <div style="max-width: 800px; margin: auto; border: 1px solid #ddd; border-top: 10px solid #28a745; border-radius: 10px; padding: 25px;">
+                <h2 style="color: #1a73e8; border-bottom: 2px solid #eee; padding-bottom: 10px;">{market_name} 全方位監控報告</h2>
+                <p style="color: #666;">生成時間: <b>{report_time} (台北時間)</b></p>
+                
+                <div style="background-color: #f8f9fa; padding: 15px; border-radius: 8px; margin: 20px 0; display: flex; justify-content: space-around; border: 1px solid #eee; text-align: center;">
+                    <div style="flex: 1;">
+                        <div style="font-size: 12px; color: #888;">應收標的</div>
+                        <div style="font-size: 18px; font-weight: bold;">{total_count}</div>
+                    </div>
+                    <div style="flex: 1; border-left: 1px solid #eee; border-right: 1px solid #eee;">
+                        <div style="font-size: 12px; color: #888;">更新成功(含快取)</div>
+                        <div style="font-size: 18px; font-weight: bold; color: #28a745;">{success_count}</div>
+                    </div>
+                    <div style="flex: 1;">
+                        <div style="font-size: 12px; color: #888;">今日覆蓋率</div>
+                        <div style="font-size: 18px; font-weight: bold; color: #1a73e8;">{success_rate}</div>
+                    </div>
+                </div>
+
+                <p style="background-color: #fff9db; padding: 12px; border-left: 4px solid #fcc419; font-size: 14px; color: #666; margin: 20px 0;">
+                    💡 <b>提示：</b>下方的數據報表若包含股票代號，可至  
+                    <a href="{p_url}" target="_blank" style="color: #e67e22; text-decoration: none; font-weight: bold;">{p_name}</a> 
+                    查看該市場之即時技術線圖。
+                </p>
+        """
+
+IMG_BLOCK_TEMPLATE = """
+            <div style="margin-bottom: 40px; text-align: center; border-bottom: 1px dashed #eee; padding-bottom: 25px;">
+                <h3 style="color: #2c3e50; text-align: left; font-size: 16px; border-left: 4px solid #3498db; padding-left: 10px;">📍 {label}</h3>
+                <img src="cid:{cid}" style="width: 100%; max-width: 750px; border-radius: 5px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); margin-top: 10px;">
+            </div>
+            """
+
+TEXT_BLOCK_TEMPLATE = """
+            <div style="margin-bottom: 20px;">
+                <h4 style="color: #16a085; margin-bottom: 8px;">📊 {period_zh} K線 最高-進攻 報酬分布明細</h4>
+                <pre style="background-color: #2d3436; color: #dfe6e9; padding: 15px; border-radius: 5px; font-size: 12px; white-space: pre-wrap; font-family: 'Courier New', monospace;">{report}</pre>
+            </div>
+            """
+
+REPORT_FOOTER = """
+                <p style="margin-top: 40px; font-size: 11px; color: #999; text-align: center; border-top: 1px solid #eee; padding-top: 20px;">
+                    此郵件由 Global Stock Monitor 系統自動發送。數據僅供參考，不構成投資建議。
+                </p>
+            </div>
+        </body>
+        </html>
+        """
+
+PERIOD_ZH = {"Week": "週", "Month": "月", "Year": "年"}
+
+# 各市場技術線圖平台：(市場代號關鍵字, 中文市場名關鍵字, 平台名稱, 網址)，依序比對
+PLATFORM_LINKS = [
+    ("us", "美國", "StockCharts", "https://stockcharts.com/"),
+    ("hk", "香港", "AASTOCKS 阿思達克", "http://www.aastocks.com/"),
+    ("cn", "中國", "東方財富網 (EastMoney)", "https://www.eastmoney.com/"),
+    ("jp", "日本", "樂天證券 (Rakuten)", "https://www.rakuten-sec.co.jp/"),
+    ("kr", "韓國", "Naver Finance", "https://finance.naver.com/"),
+]
+DEFAULT_PLATFORM = ("玩股網 (WantGoo)", "https://www.wantgoo.com/")
 
 class StockNotifier:
     def __init__(self):
@@ -11,14 +129,13 @@ class StockNotifier:
         self.tg_token = os.getenv("TELEGRAM_BOT_TOKEN")
         self.tg_chat_id = os.getenv("TELEGRAM_CHAT_ID")
         self.resend_api_key = os.getenv("RESEND_API_KEY")
-        
-        if self.resend_api_key:
-            resend.api_key = self.resend_api_key
+
+        # Telegram 簡報於背景執行緒發送，不阻塞下一個市場的流程 (程式結束前會等待送完)
+        self.tg_executor = ThreadPoolExecutor(max_workers=1)
 
     def get_now_time_str(self):
         """獲取 UTC+8 台北時間"""
-        now_utc8 = datetime.utcnow() + timedelta(hours=8)
-        return now_utc8.strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.now(TAIPEI_TZ).strftime("%Y-%m-%d %H:%M:%S")
 
     def send_telegram(self, message):
         """發送 Telegram 即時簡報"""
@@ -36,16 +153,29 @@ class StockNotifier:
             "parse_mode": "HTML"
         }
         try:
-            requests.post(url, json=payload, timeout=10)
+            get_tg_session().post(url, json=payload, timeout=10)
             return True
         except Exception as e:
             print(f"⚠️ Telegram 發送失敗: {e}")
             return False
 
+    def report_digest(self, market_name, stats, text_reports, attachments):
+        """報告內容的 SHA-256 摘要 (不含生成時間，相同數據才會得到相同摘要)"""
+        h = hashlib.sha256()
+        h.update(market_name.encode("utf-8"))
+        h.update(json.dumps(stats, sort_keys=True, default=str).encode("utf-8"))
+        for period, report in text_reports.items():
+            h.update(f"\0{period}\0{report}".encode("utf-8"))
+        for att in attachments:
+            h.update(f"\0{att['content_id']}\0".encode("utf-8"))
+            h.update(att["content"].encode("ascii"))
+        return h.hexdigest()
+
     def send_stock_report(self, market_name, img_data, report_df, text_reports, stats=None):
         """
         🚀 專業版更新：整合智慧下載統計、六國專業平台跳轉
         支援：將下載器 (Downloader) 的統計結果完美呈現於 HTML 報表頂端
+        回傳：True 已寄出、False 寄送失敗、None 內容與上次相同而略過
         """
         # 🟢 Debug 訊息：方便在終端機確認 main.py 傳進來的數值
         print(f"DEBUG: notifier 正在處理 {market_name} 報告 (Stats: {stats})")
@@ -54,7 +184,16 @@ class StockNotifier:
             print("⚠️ 缺少 Resend API Key，無法寄信。")
             return False
 
+        # 沒有任何分析結果時直接結束，不必組報表、讀圖檔與計算摘要
+        if report_df is None or report_df.empty:
+            print(f"⚠️ {market_name} 無分析數據，略過寄送。")
+            return False
+
+        import resend  # 延遲載入：只有真正要寄信時才需要
+        resend.api_key = self.resend_api_key
+
         report_time = self.get_now_time_str()
+        date_only = report_time.split(' ', 1)[0]
         
         # --- 1. 處理下載統計數據 (防止 0 或 None 導致報表崩潰) ---
         if stats is None:
@@ -78,112 +217,84 @@ class StockNotifier:
 
         # --- 💡 智慧匹配平台跳轉連結 ---
         m_id = market_name.lower()
-        if "us" in m_id or "美國" in market_name:
-            p_name, p_url = "StockCharts", "https://stockcharts.com/"
-        elif "hk" in m_id or "香港" in market_name:
-            p_name, p_url = "AASTOCKS 阿思達克", "http://www.aastocks.com/"
-        elif "cn" in m_id or "中國" in market_name:
-            p_name, p_url = "東方財富網 (EastMoney)", "https://www.eastmoney.com/"
-        elif "jp" in m_id or "日本" in market_name:
-            p_name, p_url = "樂天證券 (Rakuten)", "https://www.rakuten-sec.co.jp/"
-        elif "kr" in m_id or "韓國" in market_name:
-            p_name, p_url = "Naver Finance", "https://finance.naver.com/"
-        else:
-            p_name, p_url = "玩股網 (WantGoo)", "https://www.wantgoo.com/"
-
-        # --- 2. 構建 HTML 內容 ---
-        html_content = f"""
-        <html>
-        <body style="font-family: 'Microsoft JhengHei', sans-serif; color: #333; line-height: 1.6;">
-            <div style="max-width: 800px; margin: auto; border: 1px solid #ddd; border-top: 10px solid #28a745; border-radius: 10px; padding: 25px;">
-                <h2 style="color: #1a73e8; border-bottom: 2px solid #eee; padding-bottom: 10px;">{market_name} 全方位監控報告</h2>
-                <p style="color: #666;">生成時間: <b>{report_time} (台北時間)</b></p>
-                
-                <div style="background-color: #f8f9fa; padding: 15px; border-radius: 8px; margin: 20px 0; display: flex; justify-content: space-around; border: 1px solid #eee; text-align: center;">
-                    <div style="flex: 1;">
-                        <div style="font-size: 12px; color: #888;">應收標的</div>
-                        <div style="font-size: 18px; font-weight: bold;">{total_count}</div>
-                    </div>
-                    <div style="flex: 1; border-left: 1px solid #eee; border-right: 1px solid #eee;">
-                        <div style="font-size: 12px; color: #888;">更新成功(含快取)</div>
-                        <div style="font-size: 18px; font-weight: bold; color: #28a745;">{success_count}</div>
-                    </div>
-                    <div style="flex: 1;">
-                        <div style="font-size: 12px; color: #888;">今日覆蓋率</div>
-                        <div style="font-size: 18px; font-weight: bold; color: #1a73e8;">{success_rate}</div>
-                    </div>
-                </div>
-
-                <p style="background-color: #fff9db; padding: 12px; border-left: 4px solid #fcc419; font-size: 14px; color: #666; margin: 20px 0;">
-                    💡 <b>提示：</b>下方的數據報表若包含股票代號，可至  
-                    <a href="{p_url}" target="_blank" style="color: #e67e22; text-decoration: none; font-weight: bold;">{p_name}</a> 
-                    查看該市場之即時技術線圖。
-                </p>
-        """
-
-        # --- 3. 插入九張分析矩陣圖表 ---
-        html_content += "<div style='margin-top: 30px;'>"
-        for img in img_data:
-            html_content += f"""
-            <div style="margin-bottom: 40px; text-align: center; border-bottom: 1px dashed #eee; padding-bottom: 25px;">
-                <h3 style="color: #2c3e50; text-align: left; font-size: 16px; border-left: 4px solid #3498db; padding-left: 10px;">📍 {img['label']}</h3>
-                <img src="cid:{img['id']}" style="width: 100%; max-width: 750px; border-radius: 5px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); margin-top: 10px;">
-            </div>
-            """
-        html_content += "</div>"
+        p_name, p_url = next(
+            ((name, url) for key, zh, name, url in PLATFORM_LINKS if key in m_id or zh in market_name),
+            DEFAULT_PLATFORM)
 
-        # --- 4. 插入文字報酬分布明細 ---
-        html_content += "<div style='margin-top: 20px;'>"
-        for period, report in text_reports.items():
-            p_name_zh = {"Week": "週", "Month": "月", "Year": "年"}.get(period, period)
-            html_content += f"""
-            <div style="margin-bottom: 20px;">
-                <h4 style="color: #16a085; margin-bottom: 8px;">📊 {p_name_zh} K線 最高-進攻 報酬分布明細</h4>
-                <pre style="background-color: #2d3436; color: #dfe6e9; padding: 15px; border-radius: 5px; font-size: 12px; white-space: pre-wrap; font-family: 'Courier New', monospace;">{report}</pre>
-            </div>
-            """
-        html_content += "</div>"
-
-        html_content += """
-                <p style="margin-top: 40px; font-size: 11px; color: #999; text-align: center; border-top: 1px solid #eee; padding-top: 20px;">
-                    此郵件由 Global Stock Monitor 系統自動發送。數據僅供參考，不構成投資建議。
-                </p>
-            </div>
-        </body>
-        </html>
-        """
-
-        # --- 5. 處理附件 (Inline Embedding) ---
+        # --- 2. 處理附件 (Inline Embedding) 與圖表區塊，一次走訪 img_data 同時完成 ---
+        # 內容相同的圖表只附一次，HTML 共用同一個 cid
         attachments = []
+        img_blocks = []
+        seen = {}
         for img in img_data:
+            cid = img['id']
             try:
-                if os.path.exists(img['path']):
-                    with open(img['path'], "rb") as f:
-                        attachments.append({
-                            "content": list(f.read()),
-                            "filename": f"{img['id']}.png",
-                            "content_id": img['id'],
-                            "disposition": "inline"
-                        })
-                else:
-                    print(f"⚠️ 圖表檔案不存在: {img['path']}")
+                raw = Path(img['path']).read_bytes()
+                key = hashlib.blake2b(raw, digest_size=16).digest()
+                if key in seen:
+                    cid = seen[key]
+                    continue
+                seen[key] = cid
+                # 先壓縮圖表，再以 base64 字串傳送，避免 list(bytes) 產生大量整數物件
+                attachments.append({
+                    "content": base64.b64encode(shrink_png(raw)).decode("ascii"),
+                    "filename": f"{img['id']}.png",
+                    "content_id": img['id'],
+                    "disposition": "inline"
+                })
+            except FileNotFoundError:
+                print(f"⚠️ 圖表檔案不存在: {img['path']}")
             except Exception as e:
                 print(f"⚠️ 處理圖表附件失敗 {img['id']}: {e}")
+            finally:
+                img_blocks.append(IMG_BLOCK_TEMPLATE.format(label=img['label'], cid=cid))
+
+        # --- 3. 構建 HTML 內容 (九張分析矩陣圖表、文字報酬分布明細，各區塊以 join 一次組合) ---
+        html_content = "".join([
+            REPORT_HEAD_TEMPLATE.format(
+                market_name=market_name, report_time=report_time,
+                total_count=total_count, success_count=success_count, success_rate=success_rate,
+                p_url=p_url, p_name=p_name),
+            "<div style='margin-top: 30px;'>",
+            "".join(img_blocks),
+            "</div>",
+            "<div style='margin-top: 20px;'>",
+            "".join(TEXT_BLOCK_TEMPLATE.format(period_zh=PERIOD_ZH.get(period, period), report=report)
+                    for period, report in text_reports.items()),
+            "</div>",
+            REPORT_FOOTER,
+        ])
 
-        # --- 6. 寄送 Resend 郵件 ---
+        # --- 4. 內容與上次相同則略過寄送 ---
+        digest = self.report_digest(market_name, stats, text_reports, attachments)
+        state_path = REPORT_STATE_DIR / f"last_report_{market_name}.sha256"
+        try:
+            last_digest = state_path.read_text(encoding="utf-8").strip()
+        except OSError:
+            last_digest = ""
+        if digest == last_digest and not FORCE_SEND:
+            print(f"⏭️ {market_name} 報告內容與上次相同，略過寄送。")
+            return None
+
+        # --- 5. 寄送 Resend 郵件 ---
         try:
             resend.Emails.send({
                 "from": "StockMonitor <onboarding@resend.dev>",
                 "to": "grissomlin643@gmail.com",
-                "subject": f"🚀 {market_name} 全方位監控報告 - {report_time.split(' ')[0]}",
+                "subject": f"🚀 {market_name} 全方位監控報告 - {date_only}",
                 "html": html_content,
                 "attachments": attachments
             })
             print(f"✅ {market_name} 郵件報告已寄送！")
+            try:
+                REPORT_STATE_DIR.mkdir(parents=True, exist_ok=True)
+                state_path.write_text(digest, encoding="utf-8")
+            except OSError as e:
+                print(f"⚠️ 無法記錄報告摘要: {e}")
             
-            # --- 7. 發送 Telegram 簡報 ---
+            # --- 6. 發送 Telegram 簡報 (背景送出，郵件成功後才通知) ---
             tg_msg = f"📊 <b>{market_name} 監控報表已送達</b>\n涵蓋率: {success_rate}\n處理樣本: {success_count} 檔"
-            self.send_telegram(tg_msg)
+            self.tg_executor.submit(self.send_telegram, tg_msg)
             
             return True
         except Exception as e: